@@ -1,7 +1,123 @@
+import heapq
 import numpy as np
+import os
 import random
 import time
 import distance
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # fall back to the interpreter, e.g. when running on pypy
+    def njit(f=None, **kwargs):
+        return f if f is not None else njit
+    prange = range
+    HAVE_NUMBA = False
+
+
+@njit(cache=True)
+def _seed(seed):
+    # numba keeps its own random state, seed it from the caller
+    np.random.seed(seed)
+
+
+@njit(cache=True)
+def _rank_sample(ranks, point_rank, candidates, is_candidate, iterations):
+    """Simulate iterations rank queries on the candidates of one query.
+    ranks and point_rank are updated in place. Heap items pack a
+    (rank, point) pair into a single int64."""
+    n = len(ranks)
+    mask = (1 << 32) - 1
+    heap = [(point_rank[p] << 32) | p for p in candidates]
+    heapq.heapify(heap)
+    out = np.empty(iterations, dtype=np.int32)
+    for it in range(iterations):
+        item = heapq.heappop(heap)
+        rank, point = item >> 32, item & mask
+        while rank != point_rank[point]:
+            item = heapq.heappop(heap)
+            rank, point = item >> 32, item & mask
+
+        out[it] = point
+
+        new_rank = np.random.randint(rank, n)
+        q = ranks[new_rank]
+        ranks[rank] = q
+        ranks[new_rank] = point
+        point_rank[q] = rank
+        point_rank[point] = new_rank
+
+        heapq.heappush(heap, (new_rank << 32) | point)
+        if is_candidate[q]:
+            heapq.heappush(heap, (rank << 32) | q)
+    return out
+
+
+@njit(parallel=True, cache=True)
+def _probe_tables(hvs, mults, keys, key_start, offsets, offset_start):
+    """Pack the (m, L, k) hash values of the queries into keys and look
+    them up in all tables. Returns the bucket index of each query in
+    each table (-1 if empty) and the bucket sizes."""
+    m = hvs.shape[0]
+    L, k = mults.shape
+    buckets = np.full((m, L), -1, dtype=np.int64)
+    sizes = np.zeros((m, L), dtype=np.int64)
+    for j in prange(m):
+        for t in range(L):
+            key = np.int64(0)
+            for o in range(k):
+                key += np.int64(hvs[j, t, o]) * mults[t, o]
+            table_keys = keys[key_start[t]:key_start[t + 1]]
+            b = np.searchsorted(table_keys, key)
+            if b < len(table_keys) and table_keys[b] == key:
+                lo = offsets[offset_start[t] + b]
+                buckets[j, t] = b
+                sizes[j, t] = offsets[offset_start[t] + b + 1] - lo
+    return buckets, sizes
+
+
+@njit(parallel=True, cache=True)
+def _collect_candidates(buckets, offsets, offset_start, members, X, Y, r,
+        validate, cand_start, out):
+    """Copy the bucket members of query j to out[cand_start[j]:], sort
+    and deduplicate them in place and keep those within distance r of
+    Y[j] at the front. Returns the number of candidates kept per query."""
+    m, L = buckets.shape
+    counts = np.zeros(m, dtype=np.int64)
+    for j in prange(m):
+        pos = cand_start[j]
+        for t in range(L):
+            b = buckets[j, t]
+            if b < 0:
+                continue
+            lo = offsets[offset_start[t] + b]
+            hi = offsets[offset_start[t] + b + 1]
+            out[pos:pos + hi - lo] = members[t, lo:hi]
+            pos += hi - lo
+        cand = out[cand_start[j]:pos]
+        cand.sort()
+        cnt = 0
+        prev = -1
+        for i in range(len(cand)):
+            c = cand[i]
+            if c == prev:
+                continue
+            prev = c
+            if validate:
+                dist = 0.0
+                for d in range(X.shape[1]):
+                    diff = float(X[c, d]) - float(Y[j, d])
+                    dist += diff * diff
+                if np.sqrt(dist) > r:
+                    continue
+            # cnt <= i, so this never overwrites an unread entry
+            cand[cnt] = c
+            cnt += 1
+        counts[j] = cnt
+    return counts
+
 
 class LSHBuilder:
 
@@ -38,13 +154,55 @@ class LSH:
 
     def preprocess(self, X):
         self.X = X
-        n = len(X)
-        hvs = self._hash(X)
-        self.tables = [{} for _ in range(self.L)]
-        for i in range(n):
-            for j in range(self.L):
-                h = self._get_hash_value(hvs[i], j)
-                self.tables[j].setdefault(h, set()).add(i)
+        self._build_tables(self._hash(X))
+
+    def _build_tables(self, hvs):
+        n = len(hvs)
+        # one int64 key per point and table, kept for rebuilding tables
+        self.packed_keys = self._pack(hvs)
+        # Table j stores its sorted distinct keys, the point ids grouped
+        # by key, and offsets such that the bucket of table_keys[j][i] is
+        # table_members[j][table_offsets[j][i]:table_offsets[j][i + 1]].
+        # The per-table arrays are views into flat_keys, flat_offsets and
+        # members, which the query kernels use directly.
+        self.members = np.empty((self.L, n), dtype=np.int32)
+        table_keys = []
+        table_offsets = []
+        for j in range(self.L):
+            keys = self.packed_keys[:, j]
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            starts = np.flatnonzero(
+                np.concatenate(([True], keys[1:] != keys[:-1])))
+            table_keys.append(keys[starts])
+            table_offsets.append(np.append(starts, n).astype(np.int32))
+            self.members[j] = order
+        self.key_start = np.cumsum([0] + [len(k) for k in table_keys])
+        self.offset_start = np.cumsum([0] + [len(o) for o in table_offsets])
+        self.flat_keys = np.concatenate(table_keys)
+        self.flat_offsets = np.concatenate(table_offsets)
+        self.table_keys = np.split(self.flat_keys, self.key_start[1:-1])
+        self.table_offsets = np.split(self.flat_offsets,
+            self.offset_start[1:-1])
+        self.table_members = list(self.members)
+
+    def _find_buckets(self, table, keys):
+        """Return the bucket index of each key in table, -1 if absent."""
+        table_keys = self.table_keys[table]
+        idx = np.searchsorted(table_keys, keys)
+        found = table_keys[np.minimum(idx, len(table_keys) - 1)] == keys
+        return np.where(found, idx, -1)
+
+    def _bucket(self, table, bucket):
+        """Return the members of a bucket as a view, empty for -1."""
+        if bucket < 0:
+            return self.table_members[table][:0]
+        offsets = self.table_offsets[table]
+        return self.table_members[table][offsets[bucket]:offsets[bucket + 1]]
+
+    def _pack(self, hvs):
+        """Turn the output of _hash into an (n, L) int64 array of keys."""
+        return hvs
 
     def preprocess_query(self, Y):
         """Collect buckets, bucket sizes, and prefix_sums
@@ -53,20 +211,25 @@ class LSH:
         query_size = [0 for _ in range(len(Y))]
         bucket_sizes = [0 for _ in range(len(Y))]
         prefix_sums = [[0 for _ in range(self.L)] for _ in range(len(Y))]
-        query_results = [set() for _ in range(len(Y))]
+        query_results = [None for _ in range(len(Y))]
 
-        hvs = self._hash(Y)
-        for j, q in enumerate(hvs):
-            buckets = [(i, self._get_hash_value(q, i)) for i in range(self.L)]
+        keys = self._pack(self._hash(Y))
+        # bucket index of every query in each table, -1 if empty
+        found = [self._find_buckets(i, keys[:, i]).tolist()
+            for i in range(self.L)]
+        for j in range(len(Y)):
+            buckets = [(i, found[i][j]) for i in range(self.L)]
             query_buckets[j] = buckets
             s = 0
-            elements = set()
+            parts = []
             for i, (table, bucket) in enumerate(buckets):
-                s += len(self.tables[table].get(bucket, []))
-                elements |= self.tables[table].get(bucket, set())
+                members = self._bucket(table, bucket)
+                s += len(members)
+                parts.append(members)
                 prefix_sums[j][i] = s
-            elements = set(x for x in elements
-                if self.is_candidate_valid(Y[j], self.X[x]))
+            # sorted distinct candidate ids of all buckets
+            elements = np.unique(np.concatenate(parts))
+            elements = self._valid_candidates(Y[j], elements)
             bucket_sizes[j] = s
             query_size[j] = len(elements)
             query_results[j] = elements
@@ -79,196 +242,247 @@ class LSH:
         _, query_size, _, _, _ = self.preprocess_query(Y)
         return query_size
 
+    def _bucket_members(self, buckets):
+        """Return the member arrays of the non-empty buckets."""
+        return [self._bucket(table, bucket) for table, bucket in buckets
+            if bucket >= 0]
+
+    @staticmethod
+    def _query_seeds(m):
+        """One independent seed sequence per query, derived from the
+        global random state so that runs stay reproducible."""
+        return np.random.SeedSequence(random.randrange(2**32)).spawn(m)
+
+    @staticmethod
+    def _map_queries(query_one, m):
+        """Answer the queries 0, ..., m - 1 with query_one on a thread
+        pool. Only work done inside NumPy calls, which release the GIL,
+        runs in parallel; interpreted loops are serialized."""
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            return dict(enumerate(ex.map(query_one, range(m))))
+
     def uniform_query(self, Y, runs=100):
         query_bucket, sizes, query_results, _, _ = self.preprocess_query(Y)
-        results = {i: [] for i in range(len(Y))}
-        for j in range(len(Y)):
-            for _ in range(sizes[j] * runs):
-                if len(query_results[j]) == 0:
-                    results[j].append(-1)
-                    continue
-                while True:
-                    table, bucket = query_bucket[j][random.randrange(0, self.L)]
-                    elements = list(self.tables[table].get(bucket, [-1]))
-                    p = random.choice(elements)
-                    if p != -1 and self.is_candidate_valid(Y[j], self.X[p]):
-                        results[j].append(p)
-                        break
-        return results
+        seeds = self._query_seeds(len(Y))
+
+        def query_one(j):
+            iterations = sizes[j] * runs
+            if len(query_results[j]) == 0:
+                return np.full(iterations, -1, dtype=np.int32)
+            rng = np.random.default_rng(seeds[j])
+            # Choosing a random table, then a random point of its bucket
+            # and rejecting invalid points picks each valid bucket entry
+            # with probability proportional to 1 / bucket size. Draw all
+            # samples at once from that distribution.
+            members = self._bucket_members(query_bucket[j])
+            flat = np.concatenate(members)
+            weights = np.repeat([1.0 / len(m) for m in members],
+                [len(m) for m in members])
+            valid = np.isin(flat, query_results[j])
+            flat = flat[valid]
+            prefix = np.cumsum(weights[valid])
+            u = rng.random(iterations) * prefix[-1]
+            idx = np.searchsorted(prefix, u, side='right')
+            np.minimum(idx, len(flat) - 1, out=idx)
+            return flat[idx]
+
+        return self._map_queries(query_one, len(Y))
 
     def weighted_uniform_query(self, Y, runs=100):
-        from bisect import bisect_right
-        query_buckets, query_size, elements, bucket_sizes, prefix_sums = self.preprocess_query(Y)
-        results = {i: [] for i in range(len(Y))}
+        query_buckets, query_size, query_results, _, _ = self.preprocess_query(Y)
+        seeds = self._query_seeds(len(Y))
 
-        for j in range(len(Y)):
-            for _ in range(query_size[j] * runs):
-                if len(elements[j]) == 0:
-                    results[j].append(-1)
-                    continue
-                while True:
-                    i = random.randrange(bucket_sizes[j])
-                    pos = bisect_right(prefix_sums[j], i)
-                    table, bucket = query_buckets[j][pos]
-                    p = random.choice(list(self.tables[table][bucket]))
-                    if self.is_candidate_valid(Y[j], self.X[p]):
-                        results[j].append(p)
-                        break
-        return results
+        def query_one(j):
+            iterations = query_size[j] * runs
+            if len(query_results[j]) == 0:
+                return np.full(iterations, -1, dtype=np.int32)
+            rng = np.random.default_rng(seeds[j])
+            # A bucket chosen proportional to its size and a random member
+            # of it is a uniform entry of the concatenated buckets, so with
+            # rejection this is a uniform pick among the valid entries.
+            flat = np.concatenate(self._bucket_members(query_buckets[j]))
+            flat = flat[np.isin(flat, query_results[j])]
+            idx = rng.integers(0, len(flat), size=iterations)
+            return flat[idx]
+
+        return self._map_queries(query_one, len(Y))
 
     def opt(self, Y, runs=100, runs_per_collision=True):
         _, query_size, query_results, _, _ = self.preprocess_query(Y)
-        results = {i: [] for i in range(len(Y))}
+        seeds = self._query_seeds(len(Y))
 
-        for j in range(len(Y)):
-            elements = list(query_results[j])
+        def query_one(j):
             iterations = query_size[j] * runs
             if not runs_per_collision:
                 iterations = runs
-            for _ in range(iterations):
-                if query_size[j] == 0:
-                    results[j].append(-1)
-                    continue
-                results[j].append(random.choice(elements))
-        return results
+            if query_size[j] == 0:
+                return np.full(iterations, -1, dtype=np.int32)
+            rng = np.random.default_rng(seeds[j])
+            idx = rng.integers(0, query_size[j], size=iterations)
+            return query_results[j][idx]
 
-    def approx_degree_query(self, Y, runs=100):
-        from bisect import bisect_right
-        query_buckets, query_size, _, bucket_sizes, prefix_sums = self.preprocess_query(Y)
-        results = {i: [] for i in range(len(Y))}
+        return self._map_queries(query_one, len(Y))
 
-        for j in range(len(Y)):
-            cache = {}
+    def approx_degree_query(self, Y, runs=100):
+        query_buckets, query_size, query_results, bucket_sizes, _ = self.preprocess_query(Y)
+        seeds = self._query_seeds(len(Y))
 
-            for _ in range(query_size[j] * runs):
-                if bucket_sizes[j] == 0:
-                    results[j].append(-1)
-                    continue
+        def query_one(j):
+            iterations = query_size[j] * runs
+            if bucket_sizes[j] == 0:
+                return np.full(iterations, -1, dtype=np.int32)
+            rng = np.random.default_rng(seeds[j])
+            # contains[row[p], i] tells whether the i-th bucket holds p
+            members = [self._bucket(table, bucket)
+                for table, bucket in query_buckets[j]]
+            flat = np.concatenate(members)
+            pos = np.repeat(np.arange(self.L), [len(m) for m in members])
+            points = np.unique(flat)
+            contains = np.zeros((len(points), self.L), dtype=np.bool_)
+            contains[np.searchsorted(points, flat), pos] = True
+            row = dict(zip(points.tolist(), range(len(points))))
+            # a uniform entry of the concatenated buckets is a bucket
+            # chosen proportional to its size and a random member of it;
+            # discarding points not within distance threshold makes it a
+            # uniform valid entry
+            flat = flat[np.isin(flat, query_results[j])]
+            results = np.full(iterations, -1, dtype=np.int32)
+
+            def proposals():
+                # (point, uniform) pairs for the rejection loop, in batches
                 while True:
-                    i = random.randrange(bucket_sizes[j])
-                    pos = bisect_right(prefix_sums[j], i)
-                    table, bucket = query_buckets[j][pos]
-                    p = random.choice(list(self.tables[table][bucket]))
-                    # discard not within distance threshold
-                    if not self.is_candidate_valid(Y[j], self.X[p]):
-                        continue
-                    #if p not in cache:
-                    #    cache[p] = int(np.median([self.approx_degree(query_buckets[j], p) for _ in range(30)]))
-                    D = self.approx_degree(query_buckets[j], p) #cache[p]
-                    if random.randint(1, D) == D: # output with probability 1/D
-                        results[j].append(p)
+                    ps = flat[rng.integers(0, len(flat), size=iterations)]
+                    us = rng.random(iterations)
+                    yield from zip(ps.tolist(), us.tolist())
+
+            draws = proposals()
+            for it in range(iterations):
+                for p, u in draws:
+                    D = self.approx_degree(contains[row[p]], rng)
+                    if u * D < 1: # output with probability 1/D
+                        results[it] = p
                         break
-        return results
+            return results
+
+        return self._map_queries(query_one, len(Y))
 
     def rank_query_simulate(self, Y, runs=100):
-        import heapq
         n = len(self.X)
         m = len(Y)
         # ranks[i] is point with rank i
         # point_rank[j] is the rank of point j
-        ranks = list(range(n))
-        point_rank = [0 for _ in range(n)]
-        random.shuffle(ranks)
-
-        for rank, point in enumerate(ranks):
-            point_rank[point] = rank
+        ranks = np.random.permutation(n).astype(np.int64)
+        point_rank = np.empty(n, dtype=np.int64)
+        point_rank[ranks] = np.arange(n, dtype=np.int64)
+        if HAVE_NUMBA:
+            # interpreted, _rank_sample draws from the global state
+            _seed(random.randrange(2**32))
 
-        results = {i: [] for i in range(m)}
+        results = {i: np.empty(0, dtype=np.int32) for i in range(m)}
 
         query_buckets, query_size, query_results, _, _ = self.preprocess_query(Y)
 
+        # query_results only contains valid candidates, so the popped
+        # points need not be checked again
+        is_candidate = np.zeros(n, dtype=np.bool_)
         for j in range(m):
-            elements = list((point_rank[point], point) for point in query_results[j])
-            heapq.heapify(elements)
-            for _ in range(query_size[j] * runs):
-                while True:
-                    rank, point = heapq.heappop(elements)
-                    while rank != point_rank[point]:
-                        rank, point = heapq.heappop(elements)
-                    if self.is_candidate_valid(Y[j], self.X[point]):
-                       break
-
-                results[j].append(point)
-
-                new_rank = random.randrange(rank, n)
-                q = ranks[new_rank]
-                ranks[rank] = q
-                ranks[new_rank] = point
-                point_rank[q] = rank
-                point_rank[point] = new_rank
-
-                heapq.heappush(elements, (new_rank, point))
-                if q in query_results[j]:
-                    heapq.heappush(elements, (rank, q))
+            if query_size[j] == 0:
+                continue
+            candidates = query_results[j].astype(np.int64)
+            is_candidate[candidates] = True
+            results[j] = _rank_sample(ranks, point_rank, candidates,
+                is_candidate, query_size[j] * runs)
+            is_candidate[candidates] = False
         return results
 
-    def approx_degree(self, buckets, q):
-        num = 0
-        L = len(buckets)
-        while num < L:
-            num += 1
-            table, bucket = buckets[random.randrange(0, L)]
-            if q in self.tables[table].get(bucket, set()):
-                break
+    def approx_degree(self, contains, rng):
+        """Draw random buckets with the Generator rng until one contains
+        the point, at most L times, and return L divided by the number of
+        draws. contains[i] tells whether the i-th bucket of the query
+        holds the point."""
+        L = len(contains)
+        hits = contains[rng.integers(0, L, size=L)]
+        num = hits.argmax() + 1 if hits.any() else L
         return L // num
 
     def exact_degree(self, buckets, q):
         cnt = 0
         for table, bucket in buckets:
-            if q in self.tables[table].get(bucket, set()):
+            if q in self._bucket(table, bucket):
                 cnt += 1
         return cnt
 
     def is_candidate_valid(self, q, x):
         pass
 
-class MinHash():
-    def __init__(self):
-        # choose four random 8 bit tables
-        self.t1 = [random.randint(0, 2**32 - 1) for _ in range(2**8)]
-        self.t2 = [random.randint(0, 2**32 - 1) for _ in range(2**8)]
-        self.t3 = [random.randint(0, 2**32 - 1) for _ in range(2**8)]
-        self.t4 = [random.randint(0, 2**32 - 1) for _ in range(2**8)]
-
-    def _intern_hash(self, x):
-        return self.t1[(x >> 24) & 0xff] ^ self.t2[(x >> 16) & 0xff ] ^\
-            self.t3[(x >> 8) & 0xff] ^ self.t4[x & 0xff]
-
-    def _hash(self, X):
-        return min([self._intern_hash(x) for x in X])
-
-    def get_element(self, L):
-        h = self.hash(L)
-        for x in L:
-            if self.intern_hash(x) == h:
-                return x
+    def _valid_candidates(self, q, candidates):
+        """Return the candidate ids in the array candidates that are
+        valid for query q."""
+        valid = [self.is_candidate_valid(q, self.X[x]) for x in candidates]
+        return candidates[np.array(valid, dtype=np.bool_)]
 
 class OneBitMinHash(LSH):
     def __init__(self, k, L, r, validate=True, seed=3):
         self.k = k
         self.L = L
         self.r = r
-        self.hash_fcts = [[MinHash() for _ in range(k)] for _ in range(L)]
+        # four random 8 bit tabulation tables for each of the k * L
+        # minhash functions
+        self.T = np.random.randint(0, 2**32, size=(L, k, 4, 2**8),
+            dtype=np.uint32)
         self.validate = validate
 
+    @staticmethod
+    def _as_array(X):
+        """Store the sets in X as rows of an (n, d) uint32 array.
+        Shorter sets are padded by repeating one of their elements,
+        which leaves their minhash values unchanged."""
+        if isinstance(X, np.ndarray):
+            return X.astype('<u4', copy=False)
+        d = max(len(x) for x in X)
+        arr = np.empty((len(X), d), dtype='<u4')
+        for i, x in enumerate(X):
+            x = list(x)
+            arr[i, :len(x)] = x
+            arr[i, len(x):] = x[0]
+        return arr
+
     def _hash(self, X):
-        self.hvs = []
-        for x in X:
-            self.hvs.append([])
-            for hash_fct in self.hash_fcts:
-                h = 0
-                for hf in hash_fct:
-                    h += hf._hash(x) % 2
-                    h *= 2
-                self.hvs[-1].append(h)
-        return self.hvs
-
-    def _get_hash_value(self, arr, idx):
-        return arr[idx]
+        X = self._as_array(X)
+        n, d = X.shape
+        # b[..., 3] is the most significant byte of each element
+        b = X.view(np.uint8).reshape(n, d, 4)
+        # the k bits of table l are packed into keys[:, l] directly
+        keys = np.zeros((n, self.L), dtype=np.int64)
+        for l in range(self.L):
+            for i in range(self.k):
+                t = self.T[l, i]
+                h = t[0][b[..., 3]] ^ t[1][b[..., 2]] ^\
+                    t[2][b[..., 1]] ^ t[3][b[..., 0]]
+                keys[:, l] |= (h.min(axis=1) & 1).astype(np.int64) << i
+        return keys
+
+    def preprocess(self, X):
+        # keep the sets as a padded array to validate candidates in bulk
+        self.X = X
+        self.sets = self._as_array(X)
+        self.set_sizes = np.array([len(x) for x in X])
+        self._build_tables(self._hash(self.sets))
 
     def is_candidate_valid(self, q, x):
         return not self.validate or distance.jaccard(q, x) >= self.r
 
+    def _valid_candidates(self, q, candidates):
+        if not self.validate or len(candidates) == 0:
+            return candidates
+        # only the first size entries of a padded row are the set itself
+        sizes = self.set_sizes[candidates]
+        rows = self.sets[candidates]
+        inside = np.arange(rows.shape[1]) < sizes[:, None]
+        inter = (np.isin(rows, list(q)) & inside).sum(axis=1)
+        jac = inter / (sizes + len(q) - inter)
+        return candidates[jac >= self.r]
+
     def __str__(self):
         return f"OneBitMinHash(k={self.k}, L={self.L})"
 
@@ -280,8 +494,14 @@ class E2LSH(LSH):
     def __init__(self, k, L, w, d, r, validate=True, seed=3):
         np.random.seed(seed)
         random.seed(seed)
-        self.A = np.random.normal(0.0, 1.0, (d, k * L))
-        self.b = np.random.uniform(0.0, w, (1, k * L))
+        # hash values are floored right away, single precision suffices
+        self.A = np.random.normal(0.0, 1.0, (d, k * L)).astype(np.float32)
+        self.b = np.random.uniform(0.0, w, (1, k * L)).astype(np.float32)
+        # (XA + b) / w == X(A / w) + b / w, fold the division into A and b
+        self.A /= np.float32(w)
+        self.b /= np.float32(w)
+        self.mults = np.random.randint(np.iinfo(np.int64).min,
+            np.iinfo(np.int64).max, (L, k), dtype=np.int64) | 1
         self.w = w
         self.L = L
         self.k = k
@@ -290,18 +510,54 @@ class E2LSH(LSH):
 
     def _hash(self, X):
         #X = np.transpose(X)
+        X = np.ascontiguousarray(X, dtype=np.float32)
         hvs = np.matmul(X, self.A)
         hvs += self.b
-        hvs /= self.w
-        return np.floor(hvs).astype(np.int32)
+        hvs = np.floor(hvs).astype(np.int32)
+        return hvs.reshape(len(hvs), self.L, self.k)
 
-    def _get_hash_value(self, arr, idx):
-        return tuple(arr[idx * self.k: (idx + 1) * self.k])
+    def preprocess(self, X):
+        # datasets store the points as a list of vectors
+        X = np.asarray(X)
+        super().preprocess(X)
+
+    def preprocess_query(self, Y):
+        if not HAVE_NUMBA:
+            return super().preprocess_query(Y)
+        # hashing stays a single matmul, so that queries and data points
+        # are hashed by the same arithmetic
+        buckets, sizes = _probe_tables(self._hash(Y), self.mults,
+            self.flat_keys, self.key_start, self.flat_offsets,
+            self.offset_start)
+        prefix_sums = np.cumsum(sizes, axis=1)
+        bucket_sizes = prefix_sums[:, -1]
+        cand_start = np.concatenate(([0], np.cumsum(bucket_sizes)))
+        out = np.empty(cand_start[-1], dtype=np.int32)
+        counts = _collect_candidates(buckets, self.flat_offsets,
+            self.offset_start, self.members, self.X, np.asarray(Y),
+            self.r, self.validate, cand_start, out)
+
+        L = np.arange(self.L)
+        query_buckets = [list(zip(L.tolist(), b)) for b in buckets.tolist()]
+        query_results = [out[s:s + c] for s, c in zip(cand_start, counts)]
+        return (query_buckets, counts.tolist(), query_results,
+            bucket_sizes.tolist(), prefix_sums.tolist())
+
+    def _pack(self, hvs):
+        # random linear combination of the k values of a table, modulo
+        # 2**64; distinct values collide only with negligible probability
+        return np.einsum('nlk,lk->nl', hvs, self.mults, dtype=np.int64)
 
     def is_candidate_valid(self, q, x):
         #print(distance.l2(q, x))
         return not self.validate or distance.l2(q, x) <= self.r
 
+    def _valid_candidates(self, q, candidates):
+        if not self.validate or len(candidates) == 0:
+            return candidates
+        d = np.linalg.norm(self.X[candidates] - q, axis=1)
+        return candidates[d <= self.r]
+
     def __str__(self):
         return f"E2LSH(k={self.k}, L={self.L}, w={self.w})"
 
@@ -11,11 +11,12 @@ def compute_recall(data, queries, lsh, r):
     found = 0
     _, _, elements, _, _ = lsh.preprocess_query(queries)
     for j, q in enumerate(queries):
+        candidates = set(elements[j].tolist())
         for i, v in enumerate(data):
             if ((isinstance(lsh, E2LSH) and l2(q, v) <= r) or
                (isinstance(lsh, OneBitMinHash) and jaccard(q, v) >= r)):
                 near += 1
-                if i in elements[j]:
+                if i in candidates:
                     found += 1
     return found / near
 